@@ -1,86 +1,151 @@
 import os
-import json
+import re
+import functools
+import shutil
+import threading
 import subprocess
+import orjson
 from colorama import Fore, Style
-import datetime
 import logging
-import unicodedata
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from rich.progress import Progress, BarColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn
 
-logging.basicConfig(
-    filename='conversion.log',
-    filemode='a',
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-)
+class ColorFormatter(logging.Formatter):
+    def format(self, record):
+        mensaje = super().format(record)
+        color = getattr(record, 'color', Fore.RED if record.levelno >= logging.ERROR else Fore.WHITE)
+        return f"{color}{mensaje}{Style.RESET_ALL}"
+
+class ConsolaHandler(logging.Handler):
+    # Se usa print() en lugar de un StreamHandler fijo para que la salida pase por
+    # el sys.stdout vigente, que rich redirige mientras la barra de progreso está activa.
+    def emit(self, record):
+        try:
+            print(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+file_handler = logging.FileHandler('conversion.log', mode='a', encoding='utf-8')
+file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+consola_handler = ConsolaHandler()
+consola_handler.setFormatter(ColorFormatter('%(asctime)s - %(prefijo)s%(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+# Solo los mensajes de print_colored/print_error van a la consola; el resto queda en el log.
+consola_handler.addFilter(lambda record: hasattr(record, 'prefijo'))
+logging.basicConfig(level=logging.DEBUG, handlers=[file_handler, consola_handler])
+
+CACHE_CAPACIDADES = os.path.join(os.path.expanduser("~"), ".cache", "mkv2hls", "ffmpeg_caps.json")
+
+HLS_TIME = 10
+
+BITRATE_MAPPING = {
+    240: 400,
+    360: 800,
+    480: 1200,
+    720: 2500,
+    1080: 5000,
+    2160: 12000
+}
+
+_NVDEC_ERROR_RE = re.compile(r'cuvid|scale_npp|hwaccel|Impossible to convert', re.IGNORECASE)
+_NVENC_ERROR_RE = re.compile(r'nvenc|OpenEncodeSession', re.IGNORECASE)
+
+MAX_ARCHIVOS_CONCURRENTES = 2
+MAX_SESIONES_NVENC = 3
+MAX_TRABAJOS_AUXILIARES = 4
 
 def print_colored(text, color=Fore.WHITE):
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    mensaje = f"{current_time} - {text}"
-    print(f"{color}{mensaje}{Style.RESET_ALL}")
-    logging.info(text)
+    logging.info(text, extra={'color': color, 'prefijo': ''})
 
 def print_error(text):
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    mensaje = f"{current_time} - ERROR: {text}"
-    print(f"{Fore.RED}{mensaje}{Style.RESET_ALL}")
-    logging.error(text)
+    logging.error(text, extra={'color': Fore.RED, 'prefijo': 'ERROR: '})
 
-def remove_file(file_path):
+def huella_ffmpeg():
+    ruta_ffmpeg = shutil.which("ffmpeg")
+    if not ruta_ffmpeg:
+        return None
     try:
-        os.remove(file_path)
-        logging.info(f"Eliminado archivo: {file_path}")
-        return True
-    except Exception as e:
-        logging.error(f"Error al eliminar {file_path}: {e}")
-        return False
+        return {"path": ruta_ffmpeg, "mtime": os.stat(ruta_ffmpeg).st_mtime}
+    except OSError:
+        return None
+
+def leer_cache_capacidades():
+    huella = huella_ffmpeg()
+    if not huella:
+        return {}
+    try:
+        with open(CACHE_CAPACIDADES, "rb") as f:
+            cache = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    # Si el binario de FFmpeg cambió, las capacidades guardadas ya no son válidas.
+    if cache.get("path") != huella["path"] or cache.get("mtime") != huella["mtime"]:
+        return {}
+    return cache.get("capacidades", {})
 
+def guardar_cache_capacidad(nombre, valor):
+    huella = huella_ffmpeg()
+    if not huella:
+        return
+    capacidades = leer_cache_capacidades()
+    capacidades[nombre] = valor
+    try:
+        os.makedirs(os.path.dirname(CACHE_CAPACIDADES), exist_ok=True)
+        with open(CACHE_CAPACIDADES, "wb") as f:
+            f.write(orjson.dumps({**huella, "capacidades": capacidades}))
+    except OSError as e:
+        logging.debug(f"No se pudo guardar la caché de capacidades de FFmpeg: {e}")
+
+@functools.lru_cache(maxsize=1)
 def verificar_ffmpeg():
+    if leer_cache_capacidades().get("ffmpeg") and shutil.which("ffprobe"):
+        logging.info("FFmpeg y FFprobe están instalados y accesibles (caché).")
+        return
     try:
         subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
         subprocess.run(["ffprobe", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
         logging.info("FFmpeg y FFprobe están instalados y accesibles.")
+        guardar_cache_capacidad("ffmpeg", True)
     except (subprocess.CalledProcessError, FileNotFoundError):
         print_error("FFmpeg o FFprobe no están instalados o no están en el PATH.")
         logging.critical("FFmpeg o FFprobe no están instalados o no están en el PATH.")
         exit(1)
 
+@functools.lru_cache(maxsize=1)
 def verificar_h264_nvenc():
-    comando = ['ffmpeg', '-codecs']
-    try:
-        result = subprocess.run(comando, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        if 'h264_nvenc' in result.stdout:
-            logging.info("h264_nvenc está disponible en FFmpeg.")
-            return True
-        else:
-            logging.warning("h264_nvenc no está disponible en FFmpeg.")
+    disponible = leer_cache_capacidades().get("h264_nvenc")
+    if disponible is None:
+        comando = ['ffmpeg', '-codecs']
+        try:
+            result = subprocess.run(comando, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+        except subprocess.CalledProcessError:
+            logging.warning("No se pudo verificar h264_nvenc en FFmpeg.")
             return False
-    except subprocess.CalledProcessError:
-        logging.warning("No se pudo verificar h264_nvenc en FFmpeg.")
-        return False
-
-def sanitize_filename(name):
-    normalized = unicodedata.normalize('NFKD', name)
-    ascii_bytes = normalized.encode('ASCII', 'ignore')
-    ascii_str = ascii_bytes.decode('ASCII').replace(' ', '_')
-    ascii_str = "".join(c for c in ascii_str if c.isalnum() or c in ("-", "_")).rstrip()
-    return ascii_str
-
-def obtener_duracion(ruta_mkv):
-    comando = [
-        "ffprobe",
-        "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        ruta_mkv
-    ]
-    try:
-        duracion = float(subprocess.check_output(comando, stderr=subprocess.PIPE))
-        logging.debug(f"Duración de {ruta_mkv}: {duracion} segundos.")
-        return duracion
-    except subprocess.CalledProcessError:
-        logging.error(f"No se pudo obtener la duración de {ruta_mkv}.")
-        return None
+        disponible = 'h264_nvenc' in result.stdout
+        guardar_cache_capacidad("h264_nvenc", disponible)
+    if disponible:
+        logging.info("h264_nvenc está disponible en FFmpeg.")
+    else:
+        logging.warning("h264_nvenc no está disponible en FFmpeg.")
+    return disponible
+
+@functools.lru_cache(maxsize=1)
+def verificar_h264_cuvid():
+    disponible = leer_cache_capacidades().get("h264_cuvid")
+    if disponible is None:
+        comando = ['ffmpeg', '-decoders']
+        try:
+            result = subprocess.run(comando, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+        except subprocess.CalledProcessError:
+            logging.warning("No se pudo verificar h264_cuvid en FFmpeg.")
+            return False
+        disponible = 'h264_cuvid' in result.stdout
+        guardar_cache_capacidad("h264_cuvid", disponible)
+    if disponible:
+        logging.info("h264_cuvid está disponible en FFmpeg.")
+    else:
+        logging.warning("h264_cuvid no está disponible en FFmpeg.")
+    return disponible
 
 def generar_info_json(file_path, output_dir):
     comando = [
@@ -92,216 +157,376 @@ def generar_info_json(file_path, output_dir):
         "-i", file_path
     ]
     try:
-        result = subprocess.run(comando, capture_output=True, text=True, check=True)
-        info = json.loads(result.stdout)
+        result = subprocess.run(comando, capture_output=True, check=True)
+        info = orjson.loads(result.stdout)
         info_json_path = os.path.join(output_dir, "info.json")
-        with open(info_json_path, "w", encoding='utf-8') as f:
-            json.dump(info, f, indent=4)
+        with open(info_json_path, "wb") as f:
+            f.write(orjson.dumps(info, option=orjson.OPT_INDENT_2))
         logging.info(f"Generado info.json para {file_path}.")
         return info
     except subprocess.CalledProcessError as e:
-        print_error(f"Error al generar info.json para {file_path}: {e.stderr}")
-        logging.error(f"Error al generar info.json para {file_path}: {e.stderr}")
+        stderr_output = e.stderr.decode('utf-8', 'replace')
+        print_error(f"Error al generar info.json para {file_path}: {stderr_output}")
+        logging.error(f"Error al generar info.json para {file_path}: {stderr_output}")
         return None
 
 def ejecutar_comando_con_progreso(comando, descripcion, progress, task_id, duracion):
     try:
-        proceso = subprocess.Popen(comando, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        stderr_output = ""
-        for line in proceso.stderr:
-            stderr_output += line
-            if 'time=' in line:
-                try:
-                    time_str = line.strip().split('time=')[1].split(' ')[0]
-                    h, m, s = time_str.split(':')
-                    tiempo = float(h) * 3600 + float(m) * 60 + float(s)
-                    progress.update(task_id, completed=tiempo if tiempo <= duracion else duracion)
-                except Exception as e:
-                    logging.debug(f"Error al parsear tiempo de la línea: {line.strip()} - {e}")
+        # El comando debe incluir "-progress pipe:1 -nostats": el progreso llega por stdout en
+        # formato clave=valor y stderr solo se guarda para informar de errores. Devuelve (éxito, stderr).
+        proceso = subprocess.Popen(comando, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+        stderr_buffer = bytearray()
+        lector_stderr = threading.Thread(target=lambda: stderr_buffer.extend(proceso.stderr.read()), daemon=True)
+        lector_stderr.start()
+        fd = proceso.stdout.fileno()
+        pendiente = b''
+        estado = {}
+        ultimo_tiempo = None
+        while (chunk := os.read(fd, 8192)):
+            lineas = (pendiente + chunk).split(b'\n')
+            pendiente = lineas.pop()
+            for linea in lineas:
+                clave, _, valor = linea.strip().partition(b'=')
+                if clave != b'progress':
+                    estado[clave] = valor
+                    continue
+                # Cada bloque termina en progress=continue/end; out_time_us puede ser N/A o negativo al inicio.
+                out_time_us = estado.get(b'out_time_us', b'')
+                if out_time_us.isdigit():
+                    tiempo = int(out_time_us) / 1e6
+                    if tiempo != ultimo_tiempo:
+                        progress.update(task_id, completed=tiempo if tiempo <= duracion else duracion)
+                        ultimo_tiempo = tiempo
+        proceso.stdout.close()
         proceso.wait()
+        lector_stderr.join()
         progress.update(task_id, completed=duracion)
         if proceso.returncode != 0:
+            stderr_output = stderr_buffer.decode('utf-8', 'replace')
             print_error(f"Comando FFmpeg falló: {' '.join(comando)}\nErrores: {stderr_output}")
             logging.error(f"Comando FFmpeg falló: {' '.join(comando)}\nErrores: {stderr_output}")
-            return False
-        return True
+            return False, stderr_output
+        return True, ""
     except Exception as e:
         print_error(f"Excepción al ejecutar comando FFmpeg: {e}")
         logging.error(f"Excepción al ejecutar comando FFmpeg: {e}")
-        return False
+        return False, str(e)
 
-def obtener_resolucion_original(file_path, track_id):
-    comando = [
-        "ffprobe",
-        "-v", "error",
-        "-select_streams", f"v:{track_id}",
-        "-show_entries", "stream=width,height",
-        "-of", "csv=p=0",
-        file_path
-    ]
-    try:
-        output = subprocess.check_output(comando, stderr=subprocess.PIPE).decode().strip()
-        width, height = map(int, output.split(','))
-        logging.debug(f"Resolución original del video {track_id}: {width}x{height}")
-        return width, height
-    except subprocess.CalledProcessError:
-        logging.error(f"No se pudo obtener la resolución del video {track_id}.")
-        return None, None
-
-def extraer_pista(file_path, stream, track_type, track_name, output_dir, usar_cuda, progress, track_id, duracion_total):
-    sanitized_name = sanitize_filename(track_name)
-    if track_type == "video":
-        resoluciones = [240, 360, 480, 720, 1080, 2160]
-        original_width, original_height = obtener_resolucion_original(file_path, track_id)
-        if original_height:
-            resoluciones = [res for res in resoluciones if res <= original_height]
+def ruta_ffmpeg(path):
+    # hlsenc busca '/' en la ruta del playlist para colocar el init de fMP4 a su lado;
+    # en Windows os.path.join usa barras invertidas, así que se normaliza (Windows acepta ambos separadores).
+    return path.replace(os.path.sep, '/')
+
+def calcular_ancho(res, aspect_ratio):
+    if not aspect_ratio:
+        return -2
+    width = int(round(res * aspect_ratio / 2) * 2)
+    return width if width > 0 else -2
+
+def calcular_gop(stream):
+    for clave in ("avg_frame_rate", "r_frame_rate"):
+        try:
+            num, den = map(int, stream.get(clave, "0/0").split("/"))
+            fps = num / den
+        except (ValueError, ZeroDivisionError):
+            continue
+        if fps > 0:
+            return max(1, round(fps * HLS_TIME))
+    return 240
+
+def calcular_resoluciones(stream):
+    resoluciones = [240, 360, 480, 720, 1080, 2160]
+    # El ancho y alto ya vienen en el stream de info.json; no hace falta volver a lanzar ffprobe.
+    original_height = stream.get("height")
+    if original_height:
+        resoluciones = [res for res in resoluciones if res <= original_height]
+    return resoluciones
+
+def calcular_rungs(stream, track_id):
+    original_width, original_height = stream.get("width"), stream.get("height")
+    if original_height:
+        logging.debug(f"Resolución original del video {track_id}: {original_width}x{original_height}")
+    else:
+        logging.warning(f"No se pudo obtener la altura del video {track_id}. Usando resoluciones por defecto.")
+    aspect_ratio = original_width / original_height if original_width and original_height else None
+    return [(res, calcular_ancho(res, aspect_ratio), BITRATE_MAPPING.get(res, res * 1000)) for res in calcular_resoluciones(stream)]
+
+def pixeles(width, height):
+    # Con ancho desconocido (-2) se estima a 16:9.
+    return (width if width > 0 else round(height * 16 / 9)) * height
+
+def repartir_hilos(pesos, total):
+    # Cada entrada recibe al menos un hilo; los restantes se reparten en proporción a su peso
+    # y los sobrantes del redondeo van a las entradas con mayor residuo.
+    libres = max(0, total - len(pesos))
+    suma = sum(pesos)
+    if not suma:
+        return [1] * len(pesos)
+    cuotas = [libres * peso / suma for peso in pesos]
+    hilos = [1 + int(cuota) for cuota in cuotas]
+    sobrantes = libres - sum(int(cuota) for cuota in cuotas)
+    for i in sorted(range(len(pesos)), key=lambda i: cuotas[i] - int(cuotas[i]), reverse=True)[:sobrantes]:
+        hilos[i] += 1
+    return hilos
+
+def salidas_video(stream, track_id, rungs, output_dir, usar_cuda, gpu_pipeline):
+    track_output_dir = os.path.join(output_dir, f"video_{track_id}")
+    os.makedirs(track_output_dir, exist_ok=True)
+    cmd = []
+    hls_playlists = []
+    gop = calcular_gop(stream)
+    for res, width, bitrate, hilos in rungs:
+        hls_playlist = os.path.join(track_output_dir, f"{res}p.m3u8")
+        if gpu_pipeline:
+            scale_filter = f"scale_npp={width}:{res}:format=yuv420p"
         else:
-            logging.warning(f"No se pudo obtener la altura del video {track_id}. Usando resoluciones por defecto.")
-        track_output_dir = os.path.join(output_dir, f"{track_type}_{track_id}")
-        os.makedirs(track_output_dir, exist_ok=True)
-        hls_playlists = []
-        for res in resoluciones:
-            if original_width and original_height:
-                aspect_ratio = original_width / original_height
-                width = int(round(res * aspect_ratio / 2) * 2)
-                if width <= 0:
-                    width = -2
-            else:
-                width = -2
-            hls_playlist = os.path.join(track_output_dir, f"{res}p.m3u8")
-            bitrate_mapping = {
-                240: 400,
-                360: 800,
-                480: 1200,
-                720: 2500,
-                1080: 5000,
-                2160: 12000
-            }
-            bitrate = bitrate_mapping.get(res, res * 1000)
             scale_filter = f"scale={width}:{res}"
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-i", file_path,
-                "-map", f"0:v:{track_id}",
-                "-c:v", "h264_nvenc" if usar_cuda else "libx264",
-                "-preset", "fast",
+        cmd += [
+            "-map", f"0:v:{track_id}",
+            "-c:v", "h264_nvenc" if usar_cuda else "libx264",
+            "-threads", str(hilos),
+        ]
+        # GOP fijo de HLS_TIME segundos para que cada segmento empiece en un keyframe.
+        if usar_cuda:
+            cmd += [
+                "-preset", "p4",
+                "-tune", "hq",
+                "-rc-lookahead", "20",
+                "-g", str(gop),
+                "-no-scenecut", "1",
+                "-forced-idr", "1",
             ]
-            if usar_cuda:
-                cmd += [
-                    "-rc:v", "vbr_hq",
-                    "-b:v", f"{bitrate}k",
-                    "-maxrate", f"{bitrate}k",
-                    "-bufsize", f"{bitrate * 2}k",
-                ]
-            else:
-                cmd += [
-                    "-b:v", f"{bitrate}k",
-                ]
+        else:
+            cmd += [
+                "-preset", "veryfast",
+                "-g", str(gop),
+                "-keyint_min", str(gop),
+                "-sc_threshold", "0",
+            ]
+        cmd += [
+            "-force_key_frames", f"expr:gte(t,n_forced*{HLS_TIME})",
+        ]
+        if usar_cuda:
+            cmd += [
+                "-rc", "vbr",
+                "-multipass", "qres",
+                "-b:v", f"{bitrate}k",
+                "-maxrate", f"{bitrate}k",
+                "-bufsize", f"{bitrate * 2}k",
+            ]
+        else:
+            cmd += [
+                "-b:v", f"{bitrate}k",
+            ]
+        cmd += [
+            "-vf", scale_filter,
+        ]
+        if not gpu_pipeline:
             cmd += [
-                "-vf", scale_filter,
                 "-pix_fmt", "yuv420p",
-                "-f", "hls",
-                "-hls_time", "10",
-                "-hls_playlist_type", "vod",
-                "-hls_segment_filename", os.path.join(track_output_dir, f"segment_{res}p_%03d.ts"),
-                hls_playlist
             ]
-            duracion = duracion_total or 100
-            task_id_progress = progress.add_task(f"Video {track_id} a {res}p", total=duracion)
-            logging.debug(f"Ejecutando comando para video {track_id} a {res}p: {' '.join(cmd)}")
-            success = ejecutar_comando_con_progreso(cmd, f"Video {track_id} a {res}p", progress, task_id_progress, duracion)
-            if success:
-                hls_playlists.append((os.path.relpath(hls_playlist, output_dir).replace(os.path.sep, '/'), width, res, bitrate * 1000))
-                logging.info(f"HLS para video {track_id} a {res}p creado en {hls_playlist}.")
-            else:
-                logging.error(f"Falló la creación de HLS para video {track_id} a {res}p.")
-        return hls_playlists
-    elif track_type == "audio":
-        track_output_dir = os.path.join(output_dir, f"{track_type}_{track_id}")
-        os.makedirs(track_output_dir, exist_ok=True)
-        hls_playlist = os.path.join(track_output_dir, "audio.m3u8")
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-i", file_path,
-            "-map", f"0:a:{track_id}",
-            "-c:a", "aac",
-            "-b:a", "128k",
+        cmd += [
             "-f", "hls",
-            "-hls_time", "10",
+            "-hls_time", str(HLS_TIME),
             "-hls_playlist_type", "vod",
-            "-hls_segment_filename", os.path.join(track_output_dir, "segment_audio_%03d.ts"),
-            hls_playlist
+            "-hls_flags", "temp_file+independent_segments",
+            "-hls_segment_type", "fmp4",
+            "-hls_fmp4_init_filename", f"init_{res}p.mp4",
+            "-hls_segment_filename", ruta_ffmpeg(os.path.join(track_output_dir, f"segment_{res}p_%03d.m4s")),
+            ruta_ffmpeg(hls_playlist)
         ]
-        task_id_progress = progress.add_task(f"Audio {track_id}", total=duracion_total or 100)
-        logging.debug(f"Ejecutando comando para audio {track_id}: {' '.join(cmd)}")
-        success = ejecutar_comando_con_progreso(cmd, f"Audio {track_id}", progress, task_id_progress, duracion_total or 100)
-        if success:
-            language = stream.get("tags", {}).get("language") or "und"
-            name = stream.get("tags", {}).get("title") or language or f"Audio_{track_id}"
-            # Eliminamos la llamada a fix_encoding(name)
-            logging.info(f"HLS para audio {track_id} creado en {hls_playlist} con nombre '{name}' y lenguaje '{language}'.")
-            default = 'YES' if stream.get("disposition", {}).get("default") == 1 else 'NO'
-            return (os.path.relpath(hls_playlist, output_dir).replace(os.path.sep, '/'), name, language, default)
-        else:
-            logging.error(f"Falló la creación de HLS para audio {track_id}.")
-            return None
-    elif track_type == "subtitle":
-        track_output_dir = os.path.join(output_dir, f"{track_type}_{track_id}")
-        os.makedirs(track_output_dir, exist_ok=True)
-        vtt_file = os.path.join(track_output_dir, "subtitle.vtt")
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-i", file_path,
-            "-map", f"0:s:{track_id}",
-            "-c:s", "webvtt",
-            "-f", "webvtt",
-            vtt_file
+        hls_playlists.append((os.path.relpath(hls_playlist, output_dir).replace(os.path.sep, '/'), width, res, bitrate * 1000))
+    return cmd, hls_playlists
+
+def salidas_audio(stream, track_id, output_dir):
+    track_output_dir = os.path.join(output_dir, f"audio_{track_id}")
+    os.makedirs(track_output_dir, exist_ok=True)
+    hls_playlist = os.path.join(track_output_dir, "audio.m3u8")
+    cmd = [
+        "-map", f"0:a:{track_id}",
+        "-c:a", "aac",
+        "-b:a", "128k",
+        "-f", "hls",
+        "-hls_time", str(HLS_TIME),
+        "-hls_playlist_type", "vod",
+        "-hls_flags", "temp_file+independent_segments",
+        "-hls_segment_type", "fmp4",
+        "-hls_fmp4_init_filename", "init_audio.mp4",
+        "-hls_segment_filename", ruta_ffmpeg(os.path.join(track_output_dir, "segment_audio_%03d.m4s")),
+        ruta_ffmpeg(hls_playlist)
+    ]
+    language = stream.get("tags", {}).get("language") or "und"
+    name = stream.get("tags", {}).get("title") or language or f"Audio_{track_id}"
+    # Eliminamos la llamada a fix_encoding(name)
+    default = 'YES' if stream.get("disposition", {}).get("default") == 1 else 'NO'
+    return cmd, (os.path.relpath(hls_playlist, output_dir).replace(os.path.sep, '/'), name, language, default)
+
+def construir_comando_video_y_audio(file_path, videos, audio_streams, output_dir, usar_cuda, gpu_pipeline, hilos_por_proceso=2):
+    # -threads es una opción por encoder y por decoder: el presupuesto del proceso se reparte entre el
+    # decoder de entrada y cada resolución en proporción a los píxeles que procesa. Decodificar H.264
+    # cuesta aproximadamente una cuarta parte que codificarlo; con NVDEC el decoder no usa la CPU.
+    pesos_decoder = 0 if gpu_pipeline else sum(pixeles(s.get("width") or 0, s.get("height") or 1080) for _, s, _ in videos) / 4
+    pesos_rungs = [pixeles(width, res) for _, _, rungs in videos for res, width, _ in rungs]
+    hilos_decoder, *hilos_rungs = repartir_hilos([pesos_decoder] + pesos_rungs, hilos_por_proceso)
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-v", "error",
+        "-progress", "pipe:1",
+        "-nostats",
+        "-threads", str(hilos_decoder),
+    ]
+    if gpu_pipeline:
+        cmd += [
+            "-hwaccel", "cuda",
+            "-hwaccel_output_format", "cuda",
+            "-c:v", "h264_cuvid",
         ]
-        try:
-            subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-            logging.info(f"Subtítulo {track_id} extraído en {vtt_file}.")
-            subtitle_playlist = os.path.join(track_output_dir, "subtitle.m3u8")
-            with open(subtitle_playlist, "w", encoding='utf-8') as sub_m3u8:
-                sub_m3u8.write("#EXTM3U\n#EXT-X-VERSION:3\n")
-                sub_m3u8.write("#EXT-X-TARGETDURATION:10\n")
-                sub_m3u8.write("#EXT-X-MEDIA-SEQUENCE:0\n")
-                sub_m3u8.write("#EXTINF:10.0,\n")
-                sub_m3u8.write("subtitle.vtt\n")
-                sub_m3u8.write("#EXT-X-ENDLIST\n")
-            logging.info(f"Playlist de subtítulos creado en {subtitle_playlist}.")
-            language = stream.get("tags", {}).get("language") or "und"
-            name = stream.get("tags", {}).get("title") or language or f"Subtitle_{track_id}"
-            # Eliminamos la llamada a fix_encoding(name)
-            return (os.path.relpath(subtitle_playlist, output_dir).replace(os.path.sep, '/'), name, language)
-        except subprocess.CalledProcessError as e:
-            print_error(f"Error al extraer subtítulo {track_id}: {e.stderr}")
-            logging.error(f"Error al extraer subtítulo {track_id}: {e.stderr}")
-            return None
-    return None
+    cmd += [
+        "-i", file_path,
+    ]
+    video_playlists = []
+    audio_playlists = []
+    hilos_restantes = iter(hilos_rungs)
+    for track_id, stream, rungs in videos:
+        rungs_con_hilos = [(res, width, bitrate, next(hilos_restantes)) for res, width, bitrate in rungs]
+        salidas, hls_playlists = salidas_video(stream, track_id, rungs_con_hilos, output_dir, usar_cuda, gpu_pipeline)
+        cmd += salidas
+        video_playlists.extend(hls_playlists)
+    for track_id, stream in enumerate(audio_streams):
+        salidas, hls_playlist = salidas_audio(stream, track_id, output_dir)
+        cmd += salidas
+        audio_playlists.append(hls_playlist)
+    return cmd, video_playlists, audio_playlists
+
+def codificar_grupo(file_path, videos, audio_streams, output_dir, usar_cuda, gpu_pipeline, hilos_por_proceso, progress, task_id, duracion, descripcion):
+    def intentar(usar_nvenc, decodificar_en_gpu):
+        progress.reset(task_id, total=duracion, description=descripcion)
+        cmd, video_playlists, audio_playlists = construir_comando_video_y_audio(
+            file_path, videos, audio_streams, output_dir, usar_nvenc, decodificar_en_gpu, hilos_por_proceso
+        )
+        logging.debug(f"Ejecutando comando para {descripcion}: {' '.join(cmd)}")
+        success, errores = ejecutar_comando_con_progreso(cmd, descripcion, progress, task_id, duracion)
+        return success, errores, video_playlists, audio_playlists
+
+    success, errores, video_playlists, audio_playlists = intentar(usar_cuda, gpu_pipeline)
+    # Los reintentos solo se lanzan si el error viene de NVDEC o de NVENC; cualquier otro fallo
+    # se repetiría igual y solo costaría otra codificación completa.
+    if not success and gpu_pipeline and _NVDEC_ERROR_RE.search(errores):
+        print_colored(f"Falló la decodificación por GPU en {descripcion}. Reintentando con decodificación por CPU.", Fore.YELLOW)
+        success, errores, video_playlists, audio_playlists = intentar(usar_cuda, False)
+    if not success and usar_cuda and _NVENC_ERROR_RE.search(errores):
+        print_colored(f"Falló NVENC en {descripcion}. Reintentando con libx264.", Fore.YELLOW)
+        success, errores, video_playlists, audio_playlists = intentar(False, False)
+    if not success:
+        return None
+    return video_playlists, audio_playlists
+
+def codificar_video_y_audio(file_path, video_streams, audio_streams, output_dir, usar_cuda, progress, duracion_total, usar_nvdec=False, hilos_por_archivo=2):
+    if not video_streams and not audio_streams:
+        return [], []
+    videos = [(track_id, stream, calcular_rungs(stream, track_id)) for track_id, stream in enumerate(video_streams)]
+    # Cada resolución abre su propia sesión NVENC y las GPU de consumo limitan las sesiones simultáneas,
+    # así que con NVENC la escalera se reparte en grupos de MAX_SESIONES_NVENC salidas por proceso.
+    # Con libx264 todo va en un único proceso que demultiplexa el MKV una sola vez.
+    salidas = [(track_id, stream, rung) for track_id, stream, rungs in videos for rung in rungs]
+    tamano_grupo = MAX_SESIONES_NVENC if usar_cuda else max(1, len(salidas))
+    grupos = [salidas[i:i + tamano_grupo] for i in range(0, len(salidas), tamano_grupo)] or [[]]
+    # h264_cuvid solo decodifica H.264 8 bits 4:2:0 (no High 10 ni 4:2:2) y se aplica a todas las pistas de vídeo de la entrada.
+    gpu_pipeline = usar_cuda and usar_nvdec and bool(video_streams) and all(
+        s.get("codec_name") == "h264" and s.get("pix_fmt") in ("yuv420p", "yuvj420p") for s in video_streams
+    )
+    nombre = os.path.basename(file_path)
+    duracion = duracion_total or 100
+    task_id_progress = progress.add_task(nombre, total=duracion)
+    video_playlists = []
+    audio_playlists = []
+    for indice, grupo in enumerate(grupos):
+        videos_grupo = []
+        for track_id, stream, rung in grupo:
+            if not videos_grupo or videos_grupo[-1][0] != track_id:
+                videos_grupo.append((track_id, stream, []))
+            videos_grupo[-1][2].append(rung)
+        # El audio se codifica junto con el primer grupo.
+        audio_grupo = audio_streams if indice == 0 else []
+        descripcion = f"{nombre}: {len(grupo)} video, {len(audio_grupo)} audio"
+        if len(grupos) > 1:
+            descripcion += f" ({indice + 1}/{len(grupos)})"
+        resultado = codificar_grupo(
+            file_path, videos_grupo, audio_grupo, output_dir, usar_cuda, gpu_pipeline, hilos_por_archivo,
+            progress, task_id_progress, duracion, descripcion
+        )
+        if resultado is None:
+            logging.error(f"Falló la creación de HLS para {descripcion} de {file_path}.")
+            continue
+        video_playlists.extend(resultado[0])
+        audio_playlists.extend(resultado[1])
+    for playlist_path, _, res, _ in video_playlists:
+        logging.info(f"HLS de video a {res}p creado en {os.path.join(output_dir, playlist_path)}.")
+    for playlist_path, name, language, _ in audio_playlists:
+        logging.info(f"HLS para audio creado en {os.path.join(output_dir, playlist_path)} con nombre '{name}' y lenguaje '{language}'.")
+    return video_playlists, audio_playlists
+
+def extraer_subtitulo(file_path, stream, output_dir, track_id):
+    track_output_dir = os.path.join(output_dir, f"subtitle_{track_id}")
+    os.makedirs(track_output_dir, exist_ok=True)
+    vtt_file = os.path.join(track_output_dir, "subtitle.vtt")
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-i", file_path,
+        "-map", f"0:s:{track_id}",
+        "-c:s", "webvtt",
+        "-f", "webvtt",
+        vtt_file
+    ]
+    try:
+        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        logging.info(f"Subtítulo {track_id} extraído en {vtt_file}.")
+        subtitle_playlist = os.path.join(track_output_dir, "subtitle.m3u8")
+        with open(subtitle_playlist, "w", encoding='utf-8') as sub_m3u8:
+            sub_m3u8.write("#EXTM3U\n#EXT-X-VERSION:3\n")
+            sub_m3u8.write("#EXT-X-TARGETDURATION:10\n")
+            sub_m3u8.write("#EXT-X-MEDIA-SEQUENCE:0\n")
+            sub_m3u8.write("#EXTINF:10.0,\n")
+            sub_m3u8.write("subtitle.vtt\n")
+            sub_m3u8.write("#EXT-X-ENDLIST\n")
+        logging.info(f"Playlist de subtítulos creado en {subtitle_playlist}.")
+        language = stream.get("tags", {}).get("language") or "und"
+        name = stream.get("tags", {}).get("title") or language or f"Subtitle_{track_id}"
+        # Eliminamos la llamada a fix_encoding(name)
+        return (os.path.relpath(subtitle_playlist, output_dir).replace(os.path.sep, '/'), name, language)
+    except subprocess.CalledProcessError as e:
+        print_error(f"Error al extraer subtítulo {track_id}: {e.stderr}")
+        logging.error(f"Error al extraer subtítulo {track_id}: {e.stderr}")
+        return None
 
 def generar_master_playlist(output_dir, video_playlists, audio_playlists, subtitle_playlists):
     master_playlist_path = os.path.join(output_dir, "master.m3u8")
     try:
+        lineas = ["#EXTM3U", "#EXT-X-VERSION:3", ""]
+        lineas += [
+            f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="{name}",LANGUAGE="{language}",DEFAULT={default},AUTOSELECT=YES,URI="{audio_playlist}"'
+            for audio_playlist, name, language, default in audio_playlists
+        ]
+        lineas += [
+            f'#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="{name}",LANGUAGE="{language}",DEFAULT=NO,AUTOSELECT=YES,URI="{subtitle_playlist}"'
+            for subtitle_playlist, name, language in subtitle_playlists
+        ]
+        lineas.append("")
+        lineas += [
+            f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height},AUDIO="audio",SUBTITLES="subs"\n{playlist_path}'
+            for playlist_path, width, height, bandwidth in video_playlists
+        ]
         with open(master_playlist_path, "w", encoding='utf-8') as master_file:
-            master_file.write("#EXTM3U\n#EXT-X-VERSION:3\n\n")
-            for idx, (audio_playlist, name, language, default) in enumerate(audio_playlists):
-                master_file.write(f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="{name}",LANGUAGE="{language}",DEFAULT={default},AUTOSELECT=YES,URI="{audio_playlist}"\n')
-            for idx, (subtitle_playlist, name, language) in enumerate(subtitle_playlists):
-                master_file.write(f'#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="{name}",LANGUAGE="{language}",DEFAULT=NO,AUTOSELECT=YES,URI="{subtitle_playlist}"\n')
-            master_file.write("\n")
-            for video_playlist in video_playlists:
-                playlist_path, width, height, bandwidth = video_playlist
-                master_file.write(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height},AUDIO="audio",SUBTITLES="subs"\n{playlist_path}\n')
+            master_file.write("\n".join(lineas) + "\n")
         logging.info(f"Master playlist creado en {master_playlist_path}.")
         print_colored(f"Master playlist creado en {master_playlist_path}", Fore.GREEN)
     except Exception as e:
         print_error(f"Error al crear master.m3u8: {e}")
         logging.error(f"Error al crear master.m3u8: {e}")
 
-def procesar_archivo(archivo_mkv, eliminar_archivos=False, usar_cuda=False, progress=None):
+def procesar_archivo(archivo_mkv, eliminar_archivos=False, usar_cuda=False, progress=None, usar_nvdec=False, hilos_por_archivo=2):
     directorio_actual = os.path.dirname(os.path.abspath(archivo_mkv))
     nombre_base = os.path.splitext(os.path.basename(archivo_mkv))[0]
     ruta_mkv = os.path.join(directorio_actual, archivo_mkv)
@@ -317,59 +542,57 @@ def procesar_archivo(archivo_mkv, eliminar_archivos=False, usar_cuda=False, prog
     video_playlists = []
     audio_playlists = []
     subtitle_playlists = []
-    video_counter = 0
-    audio_counter = 0
-    subtitle_counter = 0
     duracion_total = float(info.get("format", {}).get("duration", 100))
+    pistas_por_tipo = defaultdict(list)
     for stream in streams:
-        track_type = stream.get("codec_type")
-        if track_type == "video":
-            track_id = video_counter
-            video_counter += 1
-        elif track_type == "audio":
-            track_id = audio_counter
-            audio_counter += 1
-        elif track_type == "subtitle":
-            track_id = subtitle_counter
-            subtitle_counter += 1
-        else:
-            logging.warning(f"Pista con tipo {track_type} no soportada. Saltando.")
-            continue
-        track_name = stream.get("tags", {}).get("title") or stream.get("tags", {}).get("language") or "unknown"
-        hls_playlist = extraer_pista(
-            file_path=ruta_mkv,
-            stream=stream,
-            track_type=track_type,
-            track_name=track_name,
-            output_dir=output_dir,
-            usar_cuda=usar_cuda,
-            progress=progress,
-            track_id=track_id,
-            duracion_total=duracion_total
-        )
-        if hls_playlist:
-            if track_type == "video":
-                video_playlists.extend(hls_playlist)
-            elif track_type == "audio":
-                audio_playlists.append(hls_playlist)
-            elif track_type == "subtitle":
+        pistas_por_tipo[stream.get("codec_type")].append(stream)
+    for track_type, pistas in pistas_por_tipo.items():
+        if track_type not in ("video", "audio", "subtitle"):
+            logging.warning(f"{len(pistas)} pista(s) con tipo {track_type} no soportado. Saltando.")
+    # Los subtítulos se extraen aparte en paralelo; vídeo y audio comparten un único proceso FFmpeg.
+    # El índice dentro de cada tipo es el que usa FFmpeg en -map 0:v:N / 0:a:N / 0:s:N.
+    with ThreadPoolExecutor(max_workers=MAX_TRABAJOS_AUXILIARES) as executor:
+        futuros = [
+            (track_id, executor.submit(extraer_subtitulo, ruta_mkv, stream, output_dir, track_id))
+            for track_id, stream in enumerate(pistas_por_tipo["subtitle"])
+        ]
+        try:
+            video_playlists, audio_playlists = codificar_video_y_audio(
+                file_path=ruta_mkv,
+                video_streams=pistas_por_tipo["video"],
+                audio_streams=pistas_por_tipo["audio"],
+                output_dir=output_dir,
+                usar_cuda=usar_cuda,
+                progress=progress,
+                duracion_total=duracion_total,
+                usar_nvdec=usar_nvdec,
+                hilos_por_archivo=hilos_por_archivo
+            )
+        except Exception as e:
+            print_error(f"Error al codificar video y audio de {archivo_mkv}: {e}")
+            logging.error(f"Error al codificar video y audio de {archivo_mkv}: {e}")
+        for track_id, futuro in futuros:
+            try:
+                hls_playlist = futuro.result()
+            except Exception as e:
+                print_error(f"Error al extraer la pista subtitle {track_id}: {e}")
+                logging.error(f"Error al extraer la pista subtitle {track_id}: {e}")
+                continue
+            if hls_playlist:
                 subtitle_playlists.append(hls_playlist)
     generar_master_playlist(output_dir, video_playlists, audio_playlists, subtitle_playlists)
     if eliminar_archivos:
+        # Los segmentos HLS son el resultado de la conversión, no archivos intermedios: solo se elimina el MKV.
         archivos_eliminar = [ruta_mkv]
-        for playlist in [p[0] for p in video_playlists] + [p[0] for p in audio_playlists] + [p[0] for p in subtitle_playlists]:
-            if os.path.splitext(playlist)[1].lower() not in ['.vtt', '.m3u8']:
-                segmento_dir = os.path.join(output_dir, os.path.dirname(playlist))
-                try:
-                    for f in os.listdir(segmento_dir):
-                        if f.endswith(".ts"):
-                            archivos_eliminar.append(os.path.join(segmento_dir, f))
-                except FileNotFoundError:
-                    logging.warning(f"Directorio de segmentos no encontrado: {segmento_dir}")
+        eliminados = 0
         for archivo in archivos_eliminar:
-            remove_file(archivo)
+            try:
+                os.unlink(archivo)
+                eliminados += 1
+            except OSError as e:
+                logging.error(f"Error al eliminar {archivo}: {e}")
         print_colored("Archivos intermedios eliminados.", Fore.GREEN)
-        logging.info("Archivos intermedios eliminados.")
+        logging.info(f"Eliminados {eliminados} archivos intermedios.")
     else:
         print_colored("Eliminación de archivos intermedios deshabilitada.", Fore.YELLOW)
         logging.info("Eliminación de archivos intermedios deshabilitada.")
@@ -385,8 +608,12 @@ def main():
     else:
         print_colored("CUDA not detected. Using libx264 for video encoding.", Fore.YELLOW)
         logging.info("CUDA not detected. Using libx264 for video encoding.")
+    usar_nvdec = usar_cuda and verificar_h264_cuvid()
+    if usar_nvdec:
+        print_colored("NVDEC detected. Decoding and scaling H.264 sources on the GPU.", Fore.GREEN)
+        logging.info("NVDEC detected. Decoding and scaling H.264 sources on the GPU.")
     directorio_actual = os.getcwd()
-    archivos_mkv = [f for f in os.listdir(directorio_actual) if f.lower().endswith(".mkv")]
+    archivos_mkv = [e.name for e in os.scandir(directorio_actual) if e.is_file() and e.name.lower().endswith(".mkv")]
     if not archivos_mkv:
         print_colored("No se encontraron archivos MKV en el directorio actual.", Fore.YELLOW)
         logging.info("No se encontraron archivos MKV para procesar.")
@@ -398,12 +625,24 @@ def main():
         TimeRemainingColumn(),
         transient=True
     ) as progress:
-        for archivo in archivos_mkv:
-            try:
-                procesar_archivo(archivo, eliminar_archivos=False, usar_cuda=usar_cuda, progress=progress)
-            except Exception as e:
-                print_error(f"Error al procesar el archivo {archivo}: {e}")
-                logging.error(f"Error al procesar el archivo {archivo}: {e}")
+        # Con NVENC las sesiones por GPU son limitadas, así que los archivos se procesan de uno en uno.
+        max_archivos = 1 if usar_cuda else MAX_ARCHIVOS_CONCURRENTES
+        # Cada archivo recibe una parte de los núcleos; construir_comando_video_y_audio la reparte entre el
+        # decoder y sus encoders (pistas de vídeo × resoluciones) para no sobresuscribir la CPU.
+        hilos_por_archivo = max(1, (os.cpu_count() or 1) // max_archivos)
+        logging.info(f"Usando {hilos_por_archivo} hilos por archivo.")
+        with ThreadPoolExecutor(max_workers=max_archivos) as executor:
+            futuros = {
+                executor.submit(procesar_archivo, archivo, eliminar_archivos=False, usar_cuda=usar_cuda, progress=progress, usar_nvdec=usar_nvdec, hilos_por_archivo=hilos_por_archivo): archivo
+                for archivo in archivos_mkv
+            }
+            for futuro in as_completed(futuros):
+                archivo = futuros[futuro]
+                try:
+                    futuro.result()
+                except Exception as e:
+                    print_error(f"Error al procesar el archivo {archivo}: {e}")
+                    logging.error(f"Error al procesar el archivo {archivo}: {e}")
     print_colored("MKV file queue completed, all files have been converted to HLS.", Fore.GREEN)
     logging.info("Todos los archivos MKV han sido convertidos a HLS.")
 